@@ -31,7 +31,11 @@ def add_train_config(cfg):
     cfg.INPUT.CROP.SIZE = (600, 1024)
 
     cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS = False
-    cfg.DATALOADER.NUM_WORKERS = 2
+    cfg.DATALOADER.NUM_WORKERS = 4
+    cfg.DATALOADER.PREFETCH_FACTOR = 4
+    cfg.DATALOADER.PIN_MEMORY = True
+    # copy the next batch to the GPU on a side stream during the current step
+    cfg.DATALOADER.CUDA_PREFETCH = True
 
 
     # Pseudo Data Use
@@ -65,8 +69,10 @@ def add_train_config(cfg):
     cfg.SOLVER.WEIGHT_DECAY = 0.05
     cfg.SOLVER.LOG_PERIOD = 20
     cfg.SOLVER.CHECKPOINT_PERIOD = 2000
+    # number of batches whose gradients are summed per iteration (optimizer step)
+    cfg.SOLVER.ACCUMULATE_STEPS = 1
     # optimizer
-    cfg.SOLVER.OPTIMIZER = "ADAMW"
+    cfg.SOLVER.OPTIMIZER = "ADAMW"  # "ADAMW", "ADAMW_8BIT" (needs bitsandbytes) or "SGD"
     cfg.SOLVER.BACKBONE_MULTIPLIER = 0.1
     cfg.SOLVER.CLIP_GRADIENTS = CN()
     cfg.SOLVER.CLIP_GRADIENTS.ENABLED = True
@@ -76,6 +82,7 @@ def add_train_config(cfg):
     # amp
     cfg.SOLVER.AMP = CN()
     cfg.SOLVER.AMP.ENABLED = True
+    cfg.SOLVER.AMP.DTYPE = "bf16"  # "bf16" or "fp16"
 
     # Model
     cfg.MODEL.DINOV2 = CN()
@@ -87,6 +94,8 @@ def add_train_config(cfg):
     
     cfg.MODEL.MASK_DECODER_DEPTH = 8
     cfg.MODEL.NAME = 'vitl'
+    cfg.MODEL.COMPILE = False  # torch.compile the trainable decoder modules (image encoder for --eval-only)
+    cfg.MODEL.GRAD_CHECKPOINT = False  # activation checkpointing for the mask decoder transformer layers
     
     # loss
     cfg.MODEL.MASK_FORMER = CN()
@@ -103,6 +112,9 @@ def add_train_config(cfg):
     cfg.MODEL.MASK_FORMER.REID_WEIGHT_MATCHER = 0.25
     cfg.MODEL.MASK_FORMER.IOU_WEIGHT_MATCHER = 5.0
 
+    # let cuDNN pick the fastest conv algorithm; LSJ clips are always 1024x1024
+    cfg.CUDNN_BENCHMARK = True
+
     cfg.TEST.EVAL_PERIOD = 0
     cfg.TEST.DETECTIONS_PER_IMAGE = 35
 
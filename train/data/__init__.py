@@ -1,5 +1,6 @@
 from .datasets import *
 from .build import *
+from .prefetcher import CUDAPrefetcher
 
 from .dataset_mapper import YTVISDatasetMapper, CocoClipDatasetMapper, OpenVocabularyCocoPanoClipDatasetMapper, EntitySegClipDatasetMapper
 from .dataset_mapper_uni_vid import UniVidDatasetMapper
@@ -146,13 +146,23 @@ def _train_loader_from_config(cfg, mapper, dataset_name=None, *, dataset=None, s
         "total_batch_size": cfg.SOLVER.IMS_PER_BATCH,
         "aspect_ratio_grouping": cfg.DATALOADER.ASPECT_RATIO_GROUPING,
         "num_workers": cfg.DATALOADER.NUM_WORKERS,
+        "prefetch_factor": cfg.DATALOADER.PREFETCH_FACTOR,
+        "pin_memory": cfg.DATALOADER.PIN_MEMORY,
     }
 
 
 # TODO can allow dataset as an iterable or IterableDataset to make this function more general
 @configurable(from_config=_train_loader_from_config)
 def build_detection_train_loader(
-    dataset, *, mapper, sampler=None, total_batch_size, aspect_ratio_grouping=True, num_workers=0
+    dataset,
+    *,
+    mapper,
+    sampler=None,
+    total_batch_size,
+    aspect_ratio_grouping=True,
+    num_workers=0,
+    prefetch_factor=2,
+    pin_memory=False,
 ):
     """
     Build a dataloader for object detection with some default features.
@@ -175,6 +185,10 @@ def build_detection_train_loader(
             aspect ratio for efficiency. When enabled, it requires each
             element in dataset be a dict with keys "width" and "height".
         num_workers (int): number of parallel data loading workers
+        prefetch_factor (int): number of batches loaded in advance by each worker.
+            Ignored when ``num_workers`` is 0.
+        pin_memory (bool): whether to return tensors in pinned memory, which makes
+            host-to-device copies asynchronous.
 
     Returns:
         torch.utils.data.DataLoader: a dataloader. Each output from it is a
@@ -194,6 +208,8 @@ def build_detection_train_loader(
         total_batch_size,
         aspect_ratio_grouping=aspect_ratio_grouping,
         num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        pin_memory=pin_memory,
     )
 
 
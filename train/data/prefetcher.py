@@ -0,0 +1,48 @@
+import torch
+from typing import Any, Dict, Iterable, Iterator, List
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a training data loader and copies the frames of the next batch to the GPU
+    on a side stream while the current batch is being consumed, so the host-to-device
+    copy overlaps with the training step. Only the "image" field of each video dict
+    is moved; annotations are left on the CPU as produced by the mappers.
+
+    The copies are only asynchronous if the loader returns pinned memory.
+    """
+
+    def __init__(self, loader: Iterable[List[Dict[str, Any]]], device: torch.device):
+        self.loader = loader
+        self.device = device
+
+    def _to_device(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        for video in batch:
+            video["image"] = [
+                frame.to(self.device, non_blocking=True) for frame in video["image"]
+            ]
+        return batch
+
+    def __iter__(self) -> Iterator[List[Dict[str, Any]]]:
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(loader_iter)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return self._to_device(batch)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for video in batch:
+                for frame in video["image"]:
+                    # the frames are used on the compute stream, not the copy stream
+                    frame.record_stream(current_stream)
+            next_batch = preload()
+            yield batch
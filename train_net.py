@@ -3,16 +3,22 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import contextlib
 import copy
-import itertools
+import functools
 import logging
 import os
+import re
+import time
 
-from collections import OrderedDict
-from typing import Any, Dict, List, Set
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List
 
 import torch
+import torch.utils.checkpoint
 import weakref
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks as comm_hooks
+from torch.nn.parallel import DistributedDataParallel
 
 import detectron2.utils.comm as comm
 from detectron2.checkpoint import DetectionCheckpointer
@@ -24,7 +30,6 @@ from detectron2.engine import (
     default_setup,
     launch,
     create_ddp_model,
-    AMPTrainer,
     SimpleTrainer,
     HookBase,
 )
@@ -48,6 +53,7 @@ from train import (
     UniVidDatasetMapper,
     OpenVocabularyCocoPanoClipDatasetMapper,
     EntitySegClipDatasetMapper,
+    CUDAPrefetcher,
     build_combined_loader,
     build_detection_train_loader,
     build_detection_test_loader,
@@ -55,6 +61,80 @@ from train import (
 )
 
 
+class GradientAccumulationTrainer(SimpleTrainer):
+    """
+    A :class:`SimpleTrainer` that optionally runs under fp16/bf16 autocast and
+    accumulates gradients over several batches before each optimizer step.
+
+    One iteration consumes ``accumulate_steps`` batches. Under DDP, gradients are
+    only all-reduced on the last of them. bf16 has the same exponent range as fp32,
+    so the loss is only scaled with a GradScaler for fp16.
+    """
+
+    def __init__(self, model, data_loader, optimizer, amp_dtype=None, accumulate_steps=1):
+        """
+        Args:
+            model, data_loader, optimizer: same as in :class:`SimpleTrainer`.
+            amp_dtype (torch.dtype or None): autocast dtype, or None to train in fp32.
+            accumulate_steps (int): number of batches per optimizer step.
+        """
+        super().__init__(model, data_loader, optimizer)
+        assert accumulate_steps >= 1, accumulate_steps
+        self.amp_dtype = amp_dtype
+        self.accumulate_steps = accumulate_steps
+        self.grad_scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+
+    def run_step(self):
+        assert self.model.training, "[GradientAccumulationTrainer] model was changed to eval mode!"
+
+        # Drop the gradients instead of writing zeros into every parameter's grad.
+        self.optimizer.zero_grad(set_to_none=True)
+
+        data_time = 0.0
+        accumulated_loss_dict = {}
+        for step in range(self.accumulate_steps):
+            start = time.perf_counter()
+            data = next(self._data_loader_iter)
+            data_time += time.perf_counter() - start
+
+            # Gradients of earlier batches are summed locally and all-reduced once.
+            if isinstance(self.model, DistributedDataParallel) and step < self.accumulate_steps - 1:
+                sync_context = self.model.no_sync
+            else:
+                sync_context = contextlib.nullcontext
+
+            with sync_context():
+                with torch.autocast(
+                    device_type="cuda", dtype=self.amp_dtype, enabled=self.amp_dtype is not None
+                ):
+                    loss_dict = self.model(data)
+                    if isinstance(loss_dict, torch.Tensor):
+                        loss_dict = {"total_loss": loss_dict}
+                    losses = sum(loss_dict.values()) / self.accumulate_steps
+                self.grad_scaler.scale(losses).backward()
+
+            for k, v in loss_dict.items():
+                v = v.detach() / self.accumulate_steps
+                accumulated_loss_dict[k] = accumulated_loss_dict.get(k, 0) + v
+
+        self._write_metrics(accumulated_loss_dict, data_time)
+
+        # Fused optimizers would otherwise unscale inside their kernel, after the
+        # full-model gradient clipping in optimizer.step() has seen scaled gradients.
+        self.grad_scaler.unscale_(self.optimizer)
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+
+    def state_dict(self):
+        ret = super().state_dict()
+        ret["grad_scaler"] = self.grad_scaler.state_dict()
+        return ret
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        if state_dict.get("grad_scaler"):
+            self.grad_scaler.load_state_dict(state_dict["grad_scaler"])
+
 
 class Trainer(DefaultTrainer):
     """
@@ -76,10 +156,21 @@ class Trainer(DefaultTrainer):
         optimizer = self.build_optimizer(cfg, model)
         data_loader = self.build_train_loader(cfg)
 
-        model = create_ddp_model(model, broadcast_buffers=False, find_unused_parameters=True)
-        self._trainer = (AMPTrainer if cfg.SOLVER.AMP.ENABLED else SimpleTrainer)(
-            model, data_loader, optimizer
+        model = create_ddp_model(
+            model,
+            broadcast_buffers=False,
+            find_unused_parameters=True,
+            # let param.grad alias DDP's buckets instead of keeping a second copy
+            gradient_as_bucket_view=True,
         )
+        if (
+            isinstance(model, DistributedDataParallel)
+            and cfg.SOLVER.AMP.ENABLED
+            and cfg.SOLVER.AMP.DTYPE == "bf16"
+        ):
+            # Activations are already bf16; all-reducing the gradients in bf16 halves traffic.
+            model.register_comm_hook(state=None, hook=comm_hooks.bf16_compress_hook)
+        self._trainer = self.build_train_loop(cfg, model, data_loader, optimizer)
 
         self.scheduler = self.build_lr_scheduler(cfg, optimizer)
         self.checkpointer = DetectionCheckpointer(
@@ -97,10 +188,35 @@ class Trainer(DefaultTrainer):
         self.register_hooks(self.build_hooks())
 
     @classmethod
-    def build_model(cls, cfg):
+    def build_train_loop(cls, cfg, model, data_loader, optimizer):
+        """
+        Returns:
+            SimpleTrainer: the trainer that runs each iteration.
+        """
+        amp_dtype = None
+        if cfg.SOLVER.AMP.ENABLED:
+            if cfg.SOLVER.AMP.DTYPE == "bf16":
+                amp_dtype = torch.bfloat16
+            elif cfg.SOLVER.AMP.DTYPE == "fp16":
+                amp_dtype = torch.float16
+            else:
+                raise ValueError(f"Invalid AMP dtype: {cfg.SOLVER.AMP.DTYPE}")
+        return GradientAccumulationTrainer(
+            model,
+            data_loader,
+            optimizer,
+            amp_dtype=amp_dtype,
+            accumulate_steps=cfg.SOLVER.ACCUMULATE_STEPS,
+        )
+
+    @classmethod
+    def build_model(cls, cfg, is_train=True):
         """
         Override the build_model method to instantiate the model directly
         without using Detectron2's registry.
+
+        With ``is_train=False`` the model is only prepared for evaluation: all
+        parameters are frozen at once instead of selecting the ones to tune.
         """
         if cfg.MODEL.NAME == 'vitl':
             sam2_checkpoint = "./checkpoints/sam2.1_hiera_large.pt"
@@ -111,9 +227,19 @@ class Trainer(DefaultTrainer):
         else:
             raise ValueError(f"Invalid model name: {cfg.MODEL.NAME}")
 
+        logger = logging.getLogger(__name__)
         model = build_sam2_video_query_iou_predictor(model_cfg, sam2_checkpoint,mode='train',apply_postprocessing=False, mask_decoder_depth=cfg.MODEL.MASK_DECODER_DEPTH)
-        print("MODEL_NAME:  ",cfg.MODEL.NAME)
+        logger.info("MODEL_NAME: {}".format(cfg.MODEL.NAME))
+
+        # With channels_last weights the encoder convs produce NHWC outputs, which is
+        # the layout Hiera permutes its patch embeddings into anyway.
+        model.image_encoder.to(memory_format=torch.channels_last)
 
+        if not is_train:
+            model.requires_grad_(False).eval()
+            if comm.is_main_process():
+                logger.info("Model:\n{}".format(model))
+            return model
 
         tune_name_list = [
             'sam_mask_decoder.transformer',
@@ -136,18 +262,55 @@ class Trainer(DefaultTrainer):
             "dinov2_projector",
             "backbone_feature_enhancement"
         ]
+        tune_name_pattern = re.compile("|".join(re.escape(prefix) for prefix in tune_name_list))
+        tuned_names = []
+        frozen_decoder_names = []
         for n, p in model.named_parameters():
-            if any(n.startswith(prefix) for prefix in tune_name_list):
-                print('Tuning decoder parameters:   ', n)
+            if tune_name_pattern.match(n):
+                tuned_names.append(n)
                 p.requires_grad = True
             else:
                 p.requires_grad = False
                 if 'sam_mask_decoder' in n:
-                    print('Freeze decoder parameters: ', n)
+                    frozen_decoder_names.append(n)
+        if comm.is_main_process():
+            logger.info("Tuning {} parameters".format(len(tuned_names)))
+            logger.debug("Tuning parameters: %s", tuned_names)
+            logger.debug("Freeze decoder parameters: %s", frozen_decoder_names)
+
+        if not any(p.requires_grad for p in model.image_encoder.parameters()):
+            # Nothing upstream of the decoder is trained, so run the encoder without
+            # autograd. Its outputs are plain tensors the trainable decoder starts from.
+            model.image_encoder.forward = torch.no_grad()(model.image_encoder.forward)
+
+        if cfg.MODEL.GRAD_CHECKPOINT:
+            # Recompute the trainable decoder transformer's activations in backward
+            # instead of storing them for every frame of the clip. The frozen Hiera
+            # trunk runs under no_grad and stores nothing, so it is left alone.
+            for blk in model.sam_mask_decoder.transformer.layers:
+                blk.forward = functools.partial(
+                    torch.utils.checkpoint.checkpoint, blk.forward, use_reentrant=False
+                )
+
+        if cfg.MODEL.COMPILE:
+            # Only compile the trainable heads; the frozen Hiera trunk is not worth
+            # the compile time. Compile the forward function (not the full module)
+            # so parameter names, and hence checkpoints, are unchanged. The default mode
+            # skips CUDA graphs: the decoder runs once per frame within a single autograd
+            # graph, and replaying a CUDA graph would overwrite the outputs of the
+            # previous frame that backward still needs.
+            for name in (
+                "sam_mask_decoder",
+                "point_sampler_net",
+                "offset_attention",
+                "backbone_feature_enhancement",
+                "dinov2_projector",
+            ):
+                module = getattr(model, name)
+                module.forward = torch.compile(module.forward)
         
-        logger = logging.getLogger(__name__)
-        logger.info("Model:\n{}".format(model))
-        print(model)
+        if comm.is_main_process():
+            logger.info("Model:\n{}".format(model))
         
         return model
 
@@ -220,14 +383,17 @@ class Trainer(DefaultTrainer):
 
         if len(mappers) == 1:
             mapper = mappers[0]
-            return build_detection_train_loader(cfg, mapper=mapper, dataset_name=cfg.DATASETS.TRAIN[0])
+            data_loader = build_detection_train_loader(cfg, mapper=mapper, dataset_name=cfg.DATASETS.TRAIN[0])
         else:
             loaders = [
                 build_detection_train_loader(cfg, mapper=mapper, dataset_name=dataset_name)
                 for mapper, dataset_name in zip(mappers, cfg.DATASETS.TRAIN)
             ]
-            combined_data_loader = build_combined_loader(cfg, loaders, cfg.DATASETS.DATASET_RATIO)
-            return combined_data_loader
+            data_loader = build_combined_loader(cfg, loaders, cfg.DATASETS.DATASET_RATIO)
+
+        if cfg.DATALOADER.CUDA_PREFETCH and torch.cuda.is_available():
+            data_loader = CUDAPrefetcher(data_loader, torch.device("cuda", torch.cuda.current_device()))
+        return data_loader
 
     @classmethod
     def build_test_loader(cls, cfg, dataset_name):
@@ -270,34 +436,54 @@ class Trainer(DefaultTrainer):
             torch.nn.LocalResponseNorm,
         )
 
-        params: List[Dict[str, Any]] = []
-        memo: Set[torch.nn.parameter.Parameter] = set()
-        for module_name, module in model.named_modules():
-            for module_param_name, value in module.named_parameters(recurse=False):
-                if not value.requires_grad:
-                    continue
-                # Avoid duplicating parameters
-                if value in memo:
-                    continue
-                memo.add(value)
-
-                hyperparams = copy.copy(defaults)
-                if "image_encoder" in module_name:
-                    if 'ctm' not in module_name:
-                        hyperparams["lr"] = hyperparams["lr"] * cfg.SOLVER.BACKBONE_MULTIPLIER
-                        print("image_encoder learning rate :    ", hyperparams["lr"] * cfg.SOLVER.BACKBONE_MULTIPLIER )
+        # One walk over the modules for lookup, then a single pass over the parameters.
+        # named_parameters() already skips parameters shared between modules.
+        modules = dict(model.named_modules())
+        # Parameters sharing the same hyperparameters go into one group, so foreach/fused
+        # optimizers can update them with a single kernel launch.
+        grouped_params: Dict[tuple, List[torch.nn.parameter.Parameter]] = defaultdict(list)
+        backbone_param_names = []
+        no_decay_param_names = []
+        for name, value in model.named_parameters():
+            if not value.requires_grad:
+                continue
+            module_name, _, module_param_name = name.rpartition(".")
+            module = modules[module_name]
+
+            hyperparams = copy.copy(defaults)
+            if "image_encoder" in module_name:
+                if 'ctm' not in module_name:
+                    hyperparams["lr"] = hyperparams["lr"] * cfg.SOLVER.BACKBONE_MULTIPLIER
+                    backbone_param_names.append(name)
+
+            if (
+                "relative_position_bias_table" in module_param_name
+                or "absolute_pos_embed" in module_param_name
+            ):
+                no_decay_param_names.append(name)
+                hyperparams["weight_decay"] = 0.0
+            if isinstance(module, norm_module_types):
+                hyperparams["weight_decay"] = weight_decay_norm
+            if isinstance(module, torch.nn.Embedding):
+                hyperparams["weight_decay"] = weight_decay_embed
+            grouped_params[tuple(sorted(hyperparams.items()))].append(value)
+
+        params: List[Dict[str, Any]] = [
+            {"params": values, **dict(hyperparams)} for hyperparams, values in grouped_params.items()
+        ]
 
-                if (
-                    "relative_position_bias_table" in module_param_name
-                    or "absolute_pos_embed" in module_param_name
-                ):
-                    print(module_param_name)
-                    hyperparams["weight_decay"] = 0.0
-                if isinstance(module, norm_module_types):
-                    hyperparams["weight_decay"] = weight_decay_norm
-                if isinstance(module, torch.nn.Embedding):
-                    hyperparams["weight_decay"] = weight_decay_embed
-                params.append({"params": [value], **hyperparams})
+        if comm.is_main_process():
+            logger = logging.getLogger(__name__)
+            logger.info("Built {} optimizer param groups".format(len(params)))
+            if backbone_param_names:
+                logger.info(
+                    "image_encoder learning rate {} for {} parameters".format(
+                        defaults["lr"] * cfg.SOLVER.BACKBONE_MULTIPLIER, len(backbone_param_names)
+                    )
+                )
+                logger.debug("image_encoder parameters: %s", backbone_param_names)
+            if no_decay_param_names:
+                logger.debug("No weight decay parameters: %s", no_decay_param_names)
 
         def maybe_add_full_model_gradient_clipping(optim):
             # detectron2 doesn't have full model gradient clipping now
@@ -310,19 +496,31 @@ class Trainer(DefaultTrainer):
 
             class FullModelGradientClippingOptimizer(optim):
                 def step(self, closure=None):
-                    all_params = itertools.chain(*[x["params"] for x in self.param_groups])
+                    all_params = [p for x in self.param_groups for p in x["params"]]
                     torch.nn.utils.clip_grad_norm_(all_params, clip_norm_val)
                     super().step(closure=closure)
 
             return FullModelGradientClippingOptimizer if enable else optim
 
+        # Fused kernels update all tensors of a param group at once; they need CUDA params.
+        fused = model.device.type == "cuda"
         optimizer_type = cfg.SOLVER.OPTIMIZER
         if optimizer_type == "SGD":
             optimizer = maybe_add_full_model_gradient_clipping(torch.optim.SGD)(
-                params, cfg.SOLVER.BASE_LR, momentum=cfg.SOLVER.MOMENTUM
+                params, cfg.SOLVER.BASE_LR, momentum=cfg.SOLVER.MOMENTUM, fused=fused
             )
         elif optimizer_type == "ADAMW":
             optimizer = maybe_add_full_model_gradient_clipping(torch.optim.AdamW)(
+                params, cfg.SOLVER.BASE_LR, fused=fused
+            )
+        elif optimizer_type == "ADAMW_8BIT":
+            # Keeps fp32 weights but stores the AdamW moments in 8 bits. Tensors smaller
+            # than bitsandbytes' min_8bit_size (e.g. norm weights) keep 32-bit state.
+            try:
+                import bitsandbytes as bnb
+            except ImportError as e:
+                raise ImportError("Please install bitsandbytes to use the ADAMW_8BIT optimizer") from e
+            optimizer = maybe_add_full_model_gradient_clipping(bnb.optim.AdamW8bit)(
                 params, cfg.SOLVER.BASE_LR
             )
         else:
@@ -345,7 +543,6 @@ class Trainer(DefaultTrainer):
         Returns:
             dict: a dict of result metrics
         """
-        from torch.cuda.amp import autocast
         logger = logging.getLogger(__name__)
         if isinstance(evaluators, DatasetEvaluator):
             evaluators = [evaluators]
@@ -371,7 +568,10 @@ class Trainer(DefaultTrainer):
                     )
                     results[dataset_name] = {}
                     continue
-            with autocast():
+            # bf16 keeps fp32's exponent range, so SAM2's large activations
+            # do not overflow; fall back to fp16 on GPUs without bf16 support.
+            amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            with torch.autocast(device_type="cuda", dtype=amp_dtype):
                 results_i = inference_on_dataset(model, data_loader, evaluator)
             results[dataset_name] = results_i
             if comm.is_main_process():
@@ -399,6 +599,10 @@ def setup(args):
     # cfg.merge_from_file(args.config_file)
     cfg.merge_from_list(args.opts)
     cfg.freeze()
+    # TF32 only affects matmuls/convs that stay in fp32 outside the autocast regions.
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # default_setup also sets torch.backends.cudnn.benchmark from cfg.CUDNN_BENCHMARK
     default_setup(cfg, args)
     # Setup logger for "mask_former" module
     setup_logger(output=cfg.OUTPUT_DIR, distributed_rank=comm.get_rank(), name="sam2_everything")
@@ -415,10 +619,22 @@ def main(args):
     cfg = setup(args)
 
     if args.eval_only:
-        model = Trainer.build_model(cfg)
+        model = Trainer.build_model(cfg, is_train=False)
         DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
             cfg.MODEL.WEIGHTS, resume=args.resume
         )
+        if cfg.MODEL.COMPILE:
+            import torch._inductor.config
+
+            # Store compiled graphs on disk, so later evaluation runs of the same model
+            # load them instead of recompiling.
+            torch._inductor.config.fx_graph_cache = True
+            os.environ.setdefault(
+                "TORCHINDUCTOR_CACHE_DIR", os.path.join(cfg.OUTPUT_DIR, "inductor_cache")
+            )
+            # The decoder only accepts 64x64 backbone features, so the encoder always
+            # sees 1024x1024 frames and is compiled once for that static shape.
+            model.image_encoder.forward = torch.compile(model.image_encoder.forward)
         res = Trainer.test(cfg, model)
         if cfg.TEST.AUG.ENABLED:
             raise NotImplementedError
@@ -433,6 +649,10 @@ def main(args):
 
 if __name__ == "__main__":
     torch.hub.set_dir(f"/tmp/torch_hub_cache_{os.getpid()}")
+    # Must be set before any process touches CUDA (launch initializes it in each worker
+    # before main runs); spawned workers inherit it. Reduces fragmentation from the
+    # varying clip sizes.
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
     
     args = default_argument_parser().parse_args()
     print("Command Line Args:", args)